@@ -1,3 +1,8 @@
+import asyncio
+import concurrent.futures
+import ctypes
+import errno
+import hashlib
 import os
 import time
 import shutil
@@ -6,22 +11,48 @@ import sys
 import threading
 import uuid
 import queue
-from dataclasses import dataclass
-from datetime import datetime
+import selectors
+import struct
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Callable, Optional, Dict, Tuple, Union
 
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
+try:
+    import fcntl
+except ImportError:  # Windows: reflink через ioctl недоступен
+    fcntl = None
+
+try:
+    from watchfiles import awatch, Change
+except ImportError:  # нет watchfiles → работаем через Poller
+    awatch = None
+    Change = None
+
 SUPPORTED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+# для str.endswith: проверка всех расширений за один вызов, без Path.suffix
+SUPPORTED_SUFFIX_TUPLE = tuple(sorted(SUPPORTED_EXTS))
 
 # -------------------- утилиты/настройки --------------------
 
+_LOG_LOCK = threading.Lock()
+_LAST_SEC = 0
+_LAST_STR = ""
+
 def log(msg: str):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{now}] {msg}", flush=True)
+    # префикс времени форматируем раз в секунду, а не на каждую строку
+    global _LAST_SEC, _LAST_STR
+    sec = int(time.time())
+    with _LOG_LOCK:
+        if sec != _LAST_SEC:
+            _LAST_SEC = sec
+            _LAST_STR = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))
+        sys.stdout.write(f"[{_LAST_STR}] {msg}\n")
+        sys.stdout.flush()
 
 @dataclass
 class Settings:
@@ -30,11 +61,16 @@ class Settings:
     ready_dir: Path
     archive_dir: Path
     failed_dir: Path
-    tmp_dir: Path            # для ТГ-временок (вне inbox!)
+    bg_cache_dir: Path       # кэш размытых фонов
+    bg_cache_max_bytes: int  # предел размера кэша фонов
     duration: int
     width: int
     height: int
     fps: int
+    ffmpeg_parallel: int     # сколько ffmpeg одновременно (воркеров)
+    ffmpeg_threads: int      # потоков x264 на один ffmpeg
+    video_encoder: str       # libx264 или аппаратный h264_* (см. HW_ENCODER)
+    batch_max: int           # сколько картинок кодировать одним процессом ffmpeg
     bot_token: Optional[str]
     owner_chat_id: Optional[int]
 
@@ -45,12 +81,26 @@ def load_settings() -> Settings:
     archive_dir = Path(os.getenv("ARCHIVE_DIR", "./archive")).resolve()
     work_dir = Path(os.getenv("WORK_DIR", "./work")).resolve()
     failed_dir = Path(os.getenv("FAILED_DIR", "./failed")).resolve()
-    tmp_dir = Path(os.getenv("TMP_DIR", "./tmp")).resolve()
+    bg_cache_dir = Path(os.getenv("BG_CACHE_DIR", "./bg_cache")).resolve()
+    # кадр 1080x1920 yuv420p ≈ 3 МБ: 300 МБ ≈ сотня последних фото
+    bg_cache_max_bytes = max(0, int(os.getenv("BG_CACHE_MAX_MB", "300"))) * 1024 * 1024
 
     duration = int(os.getenv("DURATION_SECONDS", "12"))  # по умолчанию 12 сек
     width = int(os.getenv("WIDTH", "1080"))
     height = int(os.getenv("HEIGHT", "1920"))
     fps = int(os.getenv("FPS", "25"))
+    # x264 сам многопоточный — по умолчанию половина ядер на воркеры, остальное делим на потоки
+    cpus = os.cpu_count() or 1
+    ffmpeg_parallel = max(1, int(os.getenv("FFMPEG_PARALLEL", str(max(1, cpus // 2)))))
+    ffmpeg_threads = max(1, cpus // ffmpeg_parallel)
+    video_encoder = detect_video_encoder(os.getenv("HW_ENCODER", "auto"))
+    batch_max = max(1, int(os.getenv("BATCH_MAX", "8")))
+    if video_encoder != "libx264":
+        # каждый выход пачки — отдельная сессия аппаратного энкодера, а у потребительских GPU
+        # их число ограничено: держим воркеры × пачку в пределах HW_MAX_SESSIONS
+        hw_sessions = max(1, int(os.getenv("HW_MAX_SESSIONS", "3")))
+        ffmpeg_parallel = min(ffmpeg_parallel, hw_sessions)
+        batch_max = min(batch_max, max(1, hw_sessions // ffmpeg_parallel))
     bot_token = os.getenv("BOT_TOKEN")
     owner_chat_id_env = os.getenv("OWNER_CHAT_ID")
     try:
@@ -58,7 +108,7 @@ def load_settings() -> Settings:
     except ValueError:
         owner_chat_id = None
 
-    for d in (input_dir, work_dir, ready_dir, archive_dir, failed_dir, tmp_dir):
+    for d in (input_dir, work_dir, ready_dir, archive_dir, failed_dir, bg_cache_dir):
         d.mkdir(parents=True, exist_ok=True)
 
     return Settings(
@@ -67,11 +117,16 @@ def load_settings() -> Settings:
         ready_dir=ready_dir,
         archive_dir=archive_dir,
         failed_dir=failed_dir,
-        tmp_dir=tmp_dir,
+        bg_cache_dir=bg_cache_dir,
+        bg_cache_max_bytes=bg_cache_max_bytes,
         duration=duration,
         width=width,
         height=height,
         fps=fps,
+        ffmpeg_parallel=ffmpeg_parallel,
+        ffmpeg_threads=ffmpeg_threads,
+        video_encoder=video_encoder,
+        batch_max=batch_max,
         bot_token=bot_token,
         owner_chat_id=owner_chat_id,
     )
@@ -83,44 +138,305 @@ def check_ffmpeg():
         log("FFmpeg не найден в PATH. Установи ffmpeg и перезапусти.")
         sys.exit(1)
 
+HW_ENCODERS = {
+    "nvenc": "h264_nvenc",
+    "videotoolbox": "h264_videotoolbox",
+    "vaapi": "h264_vaapi",
+}
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+def _encoder_works(encoder: str) -> bool:
+    # В списке -encoders кодек может быть, а железа нет — пробуем закодировать один кадр
+    # теми же опциями, что и в рабочих командах (encoder_args), иначе проба пройдёт, а кодирование — нет
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    vf = "format=yuv420p"
+    if encoder == "h264_vaapi":
+        cmd += ["-vaapi_device", VAAPI_DEVICE]
+        vf = "format=nv12,hwupload"
+    cmd += ["-f", "lavfi", "-i", "color=size=256x256", "-frames:v", "1", "-vf", vf, *encoder_args(encoder), "-f", "null", "-"]
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15).returncode == 0
+    except Exception:
+        return False
+
+def detect_video_encoder(pref: str) -> str:
+    """HW_ENCODER: auto|nvenc|videotoolbox|vaapi|none. Проверяется один раз при старте."""
+    pref = pref.strip().lower()
+    if pref in ("none", "", "libx264"):
+        return "libx264"
+    if pref == "auto":
+        candidates = list(HW_ENCODERS.values())
+    elif pref in HW_ENCODERS:
+        candidates = [HW_ENCODERS[pref]]
+    else:
+        log(f"HW_ENCODER={pref} не поддерживается — используем libx264.")
+        return "libx264"
+    try:
+        listed = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, check=True
+        ).stdout
+    except Exception:
+        return "libx264"
+    for enc in candidates:
+        if enc in listed and _encoder_works(enc):
+            return enc
+    if pref != "auto":
+        log(f"Энкодер {candidates[0]} недоступен — используем libx264.")
+    return "libx264"
+
+def encoder_args(encoder: str, threads: int = 0):
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-b:v", "3M", "-maxrate", "3M"]
+    if encoder == "h264_videotoolbox":
+        return ["-c:v", "h264_videotoolbox", "-b:v", "3M"]
+    if encoder == "h264_vaapi":
+        return ["-c:v", "h264_vaapi", "-b:v", "3M"]
+    return [
+        "-c:v", "libx264",
+        "-preset", "veryfast", "-tune", "stillimage",
+        "-threads", str(threads),
+        "-b:v", "3M", "-maxrate", "3M", "-bufsize", "6M",
+    ]
+
 def unique_stem(path_or_name: str) -> str:
     stem = Path(path_or_name).stem
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    uid = uuid.uuid4().hex[:8]
-    return f"{stem}_{ts}_{uid}"
+    # наносекунды в hex: без strftime, имена по-прежнему сортируются по времени
+    return f"{stem}_{time.time_ns():x}_{uuid.uuid4().hex[:8]}"
 
-def build_ffmpeg_cmd(img_path: Path, out_path: Path, duration: int, width: int, height: int, fps: int):
-    # Вертикаль 1080x1920, размытый фон + оригинал по центру
-    w, h = width, height
-    vf = (
-        f"[0:v]scale={w}:{h}:force_original_aspect_ratio=decrease[fg];"
-        f"[0:v]scale={w}:{h}:force_original_aspect_ratio=increase,"
-        f"crop={w}:{h},boxblur=20:1[bg];"
-        f"[bg][fg]overlay=(W-w)/2:(H-h)/2"
+def file_key(path: Path) -> str:
+    """Ключ содержимого файла (кэш фонов, дедуп фото). Читаем буфером, файл целиком в память не тянем."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # 3.11+: readinto в переиспользуемый буфер внутри C
+            return hashlib.file_digest(f, "blake2b").hexdigest()[:16]
+        h = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+        return h.hexdigest()[:16]
+
+FFMPEG_ERR_TAIL = 64  # сколько последних строк stderr ffmpeg прикладываем к ошибке
+
+def run_ffmpeg(cmd, on_progress: Optional[Callable[[float], None]] = None):
+    """
+    Запуск ffmpeg без наследования консоли: прогресс (-progress pipe:1, key=value) читаем из stdout,
+    stderr копим хвостом в отдельном потоке — при ненулевом коде он уходит в CalledProcessError.stderr.
+    """
+    tail: "deque[str]" = deque(maxlen=FFMPEG_ERR_TAIL)
+    proc = subprocess.Popen(
+        cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, errors="replace",
     )
+    err_reader = threading.Thread(target=tail.extend, args=(proc.stderr,), daemon=True)
+    err_reader.start()
+    for line in proc.stdout:
+        key, _, value = line.strip().partition("=")
+        # out_time_us — позиция в выходном видео, мкс (бывает N/A до первого кадра)
+        if on_progress is not None and key == "out_time_us" and value.isdigit():
+            on_progress(int(value) / 1_000_000)
+    rc = proc.wait()
+    err_reader.join()
+    if rc:
+        raise subprocess.CalledProcessError(rc, cmd, stderr="".join(tail))
+
+def describe_ffmpeg_error(e: subprocess.CalledProcessError, limit: int = 3000) -> str:
+    """Полное описание для log(): команда целиком + хвост stderr."""
+    details = (e.stderr or "").strip()
+    if not details:
+        return str(e)
+    return f"{e}\n{details[-limit:]}"
+
+TG_ERROR_LIMIT = 1500  # с запасом ниже лимита Telegram в 4096 символов
+
+def ffmpeg_error_for_chat(e: subprocess.CalledProcessError, settings: Settings) -> str:
+    """Для ответа в чат: без argv и абсолютных путей сервера, только код выхода и хвост stderr."""
+    details = (e.stderr or "").strip()
+    for d in (settings.work_dir, settings.ready_dir, settings.bg_cache_dir, settings.input_dir):
+        details = details.replace(str(d) + os.sep, "")
+    text = f"FFmpeg ошибка (код {e.returncode})"
+    if details:
+        text += "\n" + details[-(TG_ERROR_LIMIT - len(text) - 1):]
+    return text
+
+def get_or_build_bg(img_path: Path, cache_dir: Path, width: int, height: int) -> Path:
+    """
+    Размытый фон (scale+crop+boxblur) считаем один раз на картинку и кладём в кэш:
+    повторная отправка того же фото берёт готовый кадр, основной ffmpeg только накладывает.
+    Кадр храним сырым yuv420p — основной ffmpeg читает его без probe и без декодирования.
+    """
+    bg_path = cache_dir / f"{file_key(img_path)}_{width}x{height}.yuv"
+    try:
+        os.utime(bg_path)  # попадание в кэш: mtime служит меткой LRU для prune_bg_cache
+        return bg_path
+    except FileNotFoundError:
+        pass
+    w, h = width, height
+    # пишем во временный файл и переименовываем — параллельный воркер не увидит недописанный кадр
+    tmp_path = cache_dir / f"{bg_path.stem}.{uuid.uuid4().hex[:8]}.yuv"
+    cmd = [
+        "ffmpeg", "-nostdin", "-y", "-loglevel", "error",
+        "-i", str(img_path),
+        "-vf", f"scale={w}:{h}:force_original_aspect_ratio=increase,crop={w}:{h},boxblur=20:1,setsar=1",
+        "-frames:v", "1",
+        "-f", "rawvideo", "-pix_fmt", "yuv420p",
+        str(tmp_path),
+    ]
+    try:
+        run_ffmpeg(cmd)
+        os.replace(str(tmp_path), str(bg_path))
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return bg_path
+
+BG_CACHE_MIN_AGE = 600  # сек; свежие кадры не удаляем — их может прямо сейчас читать воркер
+_BG_PRUNE_LOCK = threading.Lock()
+
+def prune_bg_cache(cache_dir: Path, max_bytes: int):
+    """Держим кэш фонов в пределах max_bytes: удаляем самые давно использованные кадры."""
+    with _BG_PRUNE_LOCK:
+        entries = []
+        total = 0
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".yuv") or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total <= max_bytes:
+            return
+        fresh_after = time.time() - BG_CACHE_MIN_AGE
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes or mtime > fresh_after:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+def build_ffmpeg_cmd(img_path: Path, bg_path: Path, out_path: Path, duration: int, width: int, height: int, fps: int,
+                     threads: int = 0, encoder: str = "libx264"):
+    return build_ffmpeg_batch_cmd([(img_path, bg_path, out_path)], duration, width, height, fps, threads, encoder)
+
+def build_ffmpeg_batch_cmd(items, duration: int, width: int, height: int, fps: int,
+                           threads: int = 0, encoder: str = "libx264"):
+    """
+    Один процесс ffmpeg на пачку картинок: items = [(img_path, bg_path, out_path), ...].
+    У каждой картинки свои входы (фон из кэша + оригинал), своя ветка filter_complex
+    и свой выходной файл — экономим на запуске процесса и инициализации кодеков.
+    """
+    # Вертикаль 1080x1920, размытый фон + оригинал по центру (фильтры всегда на CPU)
+    w, h = width, height
+    hw_input = []
+    pix_fmt = ["-pix_fmt", "yuv420p"]
+    hw_tail = ""
+    if encoder == "h264_vaapi":
+        # кадры после overlay загружаем в память GPU
+        hw_input = ["-vaapi_device", VAAPI_DEVICE]
+        hw_tail = ",format=nv12,hwupload"
+        pix_fmt = []
+
+    inputs = []
+    graphs = []
+    outputs = []
+    for i, (img_path, bg_path, out_path) in enumerate(items):
+        bg_in, img_in = 2 * i, 2 * i + 1
+        # картинка статична: фильтры считаем на 1 кадр/сек, до fps добиваем повтором кадров на выходе
+        inputs += [
+            "-stream_loop", "-1", "-f", "rawvideo", "-pix_fmt", "yuv420p", "-video_size", f"{w}x{h}",
+            "-framerate", "1", "-t", str(duration), "-i", str(bg_path),
+        ]
+        inputs += ["-loop", "1", "-framerate", "1", "-t", str(duration), "-i", str(img_path)]
+        graphs.append(
+            f"[{img_in}:v]scale={w}:{h}:force_original_aspect_ratio=decrease[fg{i}];"
+            f"[{bg_in}:v][fg{i}]overlay=(W-w)/2:(H-h)/2{hw_tail}[v{i}]"
+        )
+        outputs += [
+            "-map", f"[v{i}]",
+            "-r", str(fps),
+            *encoder_args(encoder, threads),
+            *pix_fmt,
+            "-movflags", "+faststart",
+            str(out_path),
+        ]
     return [
         "ffmpeg",
+        "-nostdin",
         "-y",
-        "-loglevel", "error", "-stats",
-        "-loop", "1",
-        "-i", str(img_path),
-        "-t", str(duration),
-        "-r", str(fps),
-        "-filter_complex", vf,
-        "-shortest",
-        "-c:v", "libx264",
-        "-b:v", "3M", "-maxrate", "3M", "-bufsize", "6M",
-        "-pix_fmt", "yuv420p",
-        "-movflags", "+faststart",
-        str(out_path),
+        "-loglevel", "error",
+        "-progress", "pipe:1",
+        *hw_input,
+        *inputs,
+        "-filter_complex", ";".join(graphs),
+        *outputs,
     ]
 
-def convert_image_to_video(img_path: Path, ready_dir: Path, duration: int, width: int, height: int, fps: int) -> Path:
-    out_path = ready_dir / (unique_stem(img_path) + ".mp4")
-    cmd = build_ffmpeg_cmd(img_path, out_path, duration, width, height, fps)
+def convert_image_to_video(img_path: Path, ready_dir: Path, bg_cache_dir: Path, duration: int, width: int, height: int,
+                           fps: int, threads: int = 0, encoder: str = "libx264") -> Path:
+    return convert_images_to_videos(
+        [img_path], ready_dir, bg_cache_dir, duration, width, height, fps, threads, encoder
+    )[0]
+
+def convert_images_to_videos(img_paths, ready_dir: Path, bg_cache_dir: Path, duration: int, width: int, height: int,
+                             fps: int, threads: int = 0, encoder: str = "libx264",
+                             on_progress: Optional[Callable[[float], None]] = None):
+    bg_paths = [get_or_build_bg(p, bg_cache_dir, width, height) for p in img_paths]
+    out_paths = [ready_dir / (unique_stem(p) + ".mp4") for p in img_paths]
+    # x264-потоки делим между энкодерами пачки, чтобы не раздувать их число
+    per_output = max(1, threads // len(img_paths)) if threads else 0
+    items = list(zip(img_paths, bg_paths, out_paths))
+    cmd = build_ffmpeg_batch_cmd(items, duration, width, height, fps, per_output, encoder)
     log("FFmpeg: " + " ".join(cmd))
-    subprocess.run(cmd, check=True)
-    return out_path
+    try:
+        run_ffmpeg(cmd, on_progress)
+    except subprocess.CalledProcessError:
+        # недописанные файлы пачки в ready/ не оставляем
+        for p in out_paths:
+            p.unlink(missing_ok=True)
+        raise
+    return out_paths
+
+FICLONE = 0x40049409  # ioctl reflink (btrfs/XFS): копия без переноса данных
+
+def _copy_fd(src_fd: int, dst_fd: int):
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+    # copy_file_range: копирует ядро, без прогона байтов через Python
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src_fd, dst_fd, 1 << 30):
+                pass
+            return
+        except OSError:
+            pass  # смещения fd уже сдвинуты — добиваем остаток обычным копированием
+    with open(src_fd, "rb", closefd=False) as fsrc, open(dst_fd, "wb", closefd=False) as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+def _fast_move(src: Path, dst: Path):
+    try:
+        os.replace(str(src), str(dst))  # атомарный перенос в пределах диска
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # другой диск/маунт: reflink → copy_file_range → буферное копирование, затем удаляем исходник
+    with open(src, "rb") as fsrc:
+        # "xb" открываем до try: если dst уже есть, это чужой файл — удалять его нельзя
+        fdst = open(dst, "xb")
+        try:
+            with fdst:
+                _copy_fd(fsrc.fileno(), fdst.fileno())
+            shutil.copystat(str(src), str(dst))
+        except BaseException:
+            dst.unlink(missing_ok=True)
+            raise
+    os.unlink(str(src))
 
 def safe_move(src: Path, dst_dir: Path, keep_ext: bool = True) -> Path:
     dst_dir.mkdir(parents=True, exist_ok=True)
@@ -128,83 +444,378 @@ def safe_move(src: Path, dst_dir: Path, keep_ext: bool = True) -> Path:
     if keep_ext:
         name += src.suffix.lower()
     dst = dst_dir / name
-    os.replace(str(src), str(dst))  # атомарный перенос в пределах диска
+    _fast_move(src, dst)
     return dst
 
-# -------------------- очередь работ (1 воркер) --------------------
+# -------------------- очередь работ (пул воркеров) --------------------
 
 @dataclass
 class Job:
     src_path: Path  # путь к файлу в WORK_DIR (мы всегда работаем из work/)
     is_temp: bool   # был ли файл временным (например из ТГ), влияет только на логи
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:8])  # для корреляции строк лога
+    content_key: Optional[str] = None  # file_key исходника — для дедупа повторных фото
+    progress_s: float = 0.0  # сколько секунд видео уже закодировано (из -progress ffmpeg)
+    # если задан — воркер передаёт сюда путь к видео (или исключение)
+    result_future: Optional[concurrent.futures.Future] = None
+
+def _resolve_job(job: Job, result: Optional[Path] = None, exc: Optional[BaseException] = None):
+    fut = job.result_future
+    if fut is None or fut.done():
+        return
+    try:
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        pass  # ожидающий уже отменил (таймаут)
 
 class JobQueue:
+    BATCH_WINDOW = 0.25  # сколько ждём добора пачки, сек
+    MAX_CACHED_VIDEOS = 1000  # предел карты дедупа повторных фото
+
     def __init__(self, settings: Settings):
         self.settings = settings
         self.q: "queue.Queue[Job]" = queue.Queue()
-        self.worker = threading.Thread(target=self._worker, daemon=True)
+        self.workers = [
+            threading.Thread(target=self._worker, daemon=True)
+            for _ in range(settings.ffmpeg_parallel)
+        ]
         self._stop = threading.Event()
+        # LRU content_key → готовое видео (свежие в конце), не больше MAX_CACHED_VIDEOS
+        self._videos: "OrderedDict[str, Path]" = OrderedDict()
+        self._videos_lock = threading.Lock()
 
     def start(self):
-        self.worker.start()
+        for w in self.workers:
+            w.start()
 
     def stop(self):
         self._stop.set()
-        self.q.put(None)  # разблокировать
-        self.worker.join(timeout=2)
+        for _ in self.workers:
+            self.q.put(None)  # разблокировать каждого воркера
+        for w in self.workers:
+            w.join(timeout=2)
 
     def add(self, job: Job):
         self.q.put(job)
 
+    def cached_video(self, key: str) -> Optional[Path]:
+        with self._videos_lock:
+            video_path = self._videos.get(key)
+            if video_path is None:
+                return None
+            if not video_path.exists():
+                # видео удалили из ready/ — запись больше не нужна
+                del self._videos[key]
+                return None
+            self._videos.move_to_end(key)
+            return video_path
+
+    def _next_batch(self):
+        """Ждём задачу, затем добираем из очереди до batch_max штук в окне BATCH_WINDOW."""
+        job = self.q.get()
+        if job is None:
+            return [], True
+        batch = [job]
+        deadline = time.monotonic() + self.BATCH_WINDOW
+        while len(batch) < self.settings.batch_max:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                # стоп-сигнал: доделываем собранное и выходим
+                return batch, True
+            batch.append(job)
+        return batch, False
+
     def _worker(self):
         log("Worker: стартовал.")
         while not self._stop.is_set():
-            job = self.q.get()
-            if job is None:
+            batch, stop = self._next_batch()
+            try:
+                if batch:
+                    self._process(batch)
+            finally:
+                for _ in batch:
+                    self.q.task_done()
+            if stop:
                 break
-            src = job.src_path
+
+    def _process(self, batch):
+        names = ", ".join(f"{j.src_path.name} [{j.job_id}]" for j in batch)
+
+        def on_progress(seconds: float):
+            for job in batch:
+                job.progress_s = seconds
+
+        try:
+            log(f"Worker: обрабатываю {names}")
+            # Конвертация (одним ffmpeg на всю пачку)
+            videos = convert_images_to_videos(
+                [j.src_path for j in batch], self.settings.ready_dir, self.settings.bg_cache_dir,
+                self.settings.duration, self.settings.width, self.settings.height, self.settings.fps,
+                self.settings.ffmpeg_threads, self.settings.video_encoder, on_progress,
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                # одна битая картинка не должна валить остальные — повторяем по одной
+                log(f"Пачка не удалась ({e}), обрабатываю по одной.")
+                for job in batch:
+                    self._process([job])
+                return
+            src = batch[0].src_path
+            job_id = batch[0].job_id
+            if isinstance(e, subprocess.CalledProcessError):
+                log(f"FFmpeg ошибка [{job_id}]: {describe_ffmpeg_error(e)}")
+            else:
+                log(f"Ошибка обработки [{job_id}] {src.name}: {e}")
+            # Даже при ошибке переносим исходник в failed/, чтобы не зациклиться
             try:
-                log(f"Worker: обрабатываю {src.name}")
-                # Конвертация
-                video_path = convert_image_to_video(
-                    src, self.settings.ready_dir,
-                    self.settings.duration, self.settings.width, self.settings.height, self.settings.fps
-                )
-                # Успех → исходник в archive
-                safe_move(src, self.settings.archive_dir, keep_ext=True)
-                log(f"Worker: готово {video_path.name}")
-            except subprocess.CalledProcessError as e:
-                log(f"FFmpeg ошибка: {e}")
-                # Даже при ошибке переносим исходник в failed/, чтобы не зациклиться
-                try:
-                    safe_move(src, self.settings.failed_dir, keep_ext=True)
-                except Exception as e2:
-                    log(f"Не удалось перенести в failed/: {e2}")
+                safe_move(src, self.settings.failed_dir, keep_ext=True)
+            except Exception as e2:
+                log(f"Не удалось перенести в failed/: {e2}")
+            _resolve_job(batch[0], exc=e)
+            return
+
+        try:
+            prune_bg_cache(self.settings.bg_cache_dir, self.settings.bg_cache_max_bytes)
+        except OSError as e:
+            log(f"Не удалось почистить bg_cache/: {e}")
+
+        for job, video_path in zip(batch, videos):
+            # Успех → исходник в archive
+            try:
+                safe_move(job.src_path, self.settings.archive_dir, keep_ext=True)
+            except Exception as e:
+                log(f"Не удалось перенести в archive/: {e}")
+            log(f"Worker: готово [{job.job_id}] {video_path.name}")
+            if job.content_key:
+                with self._videos_lock:
+                    self._videos[job.content_key] = video_path
+                    self._videos.move_to_end(job.content_key)
+                    if len(self._videos) > self.MAX_CACHED_VIDEOS:
+                        self._videos.popitem(last=False)
+            _resolve_job(job, result=video_path)
+
+# -------------------- watcher inbox --------------------
+
+def claim_file(path: Path, settings: Settings, jobs: JobQueue):
+    """Claim: переносим файл из inbox в WORK и ставим в очередь."""
+    try:
+        claimed = safe_move(path, settings.work_dir, keep_ext=True)
+        job = Job(src_path=claimed, is_temp=False)
+        jobs.add(job)
+        log(f"Claimed: {claimed.name} [{job.job_id}]")
+    except Exception as e:
+        log(f"Не удалось перенести в work/: {e}")
+
+class FsWatcher:
+    """
+    Событийный watcher на watchfiles (inotify/FSEvents):
+    - Получаем изменения INPUT_DIR от ядра, без опроса
+    - Файл считается записанным, когда его размер не менялся SETTLE_SECONDS (как 3 тика × 0.5 с у поллера)
+    - Работает как asyncio-задача в том же цикле, что и Telegram-бот
+    """
+    STABLE_DELAY_MS = 300  # как часто перепроверяем размер ожидающих файлов
+    SETTLE_SECONDS = 1.5   # сколько размер должен не меняться: паузы SMB/NFS/scp не должны дать обрезанный файл
+    RETRY_DELAY = 2.0      # пауза перед повторной подпиской после ошибки, сек
+
+    def __init__(self, settings: Settings, jobs: JobQueue):
+        self.settings = settings
+        self.jobs = jobs
+        # путь → (размер при прошлом наблюдении, с какого момента он не менялся, monotonic)
+        self._pending: Dict[Path, Tuple[int, float]] = {}
+        # с 3.10 Event не привязан к циклу при создании — можно создать заранее
+        self._stop = asyncio.Event()
+
+    async def run(self):
+        log("FS watcher: запущен (watchfiles).")
+        # файлы, которые лежали в inbox до старта
+        for p in self.settings.input_dir.glob("*"):
+            if p.is_file() and p.name.lower().endswith(SUPPORTED_SUFFIX_TUPLE):
+                self._pending.setdefault(p, (-1, time.monotonic()))
+        # ошибка не должна останавливать watcher навсегда: логируем и подписываемся заново
+        while not self._stop.is_set():
+            try:
+                await self._watch()
             except Exception as e:
-                log(f"Ошибка обработки {src.name}: {e}")
+                log(f"Watcher error: {e}")
                 try:
-                    safe_move(src, self.settings.failed_dir, keep_ext=True)
-                except Exception as e2:
-                    log(f"Не удалось перенести в failed/: {e2}")
-            finally:
-                self.q.task_done()
+                    await asyncio.wait_for(self._stop.wait(), timeout=self.RETRY_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _watch(self):
+        async for changes in awatch(
+            self.settings.input_dir,
+            stop_event=self._stop,
+            recursive=False,  # как и остальные watcher'ы — только верхний уровень inbox
+            rust_timeout=self.STABLE_DELAY_MS,
+            yield_on_timeout=True,
+        ):
+            for change, raw_path in changes:
+                path = Path(raw_path)
+                if change == Change.deleted:
+                    self._pending.pop(path, None)
+                elif raw_path.lower().endswith(SUPPORTED_SUFFIX_TUPLE):
+                    # событие = файл ещё трогают: окно стабильности начинаем заново
+                    self._pending[path] = (-1, time.monotonic())
+            await self._check_pending()
+
+    def stop(self):
+        self._stop.set()
+
+    async def _check_pending(self):
+        now = time.monotonic()
+        for path, (prev_size, since) in list(self._pending.items()):
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                self._pending.pop(path, None)
+                continue
+            except OSError as e:
+                # нет доступа и т.п. — забываем файл, остальные продолжаем обрабатывать
+                log(f"Watcher error: {path.name}: {e}")
+                self._pending.pop(path, None)
+                continue
+            if size != prev_size:
+                self._pending[path] = (size, now)
+            elif size > 0 and now - since >= self.SETTLE_SECONDS:
+                self._pending.pop(path, None)
+                # перенос между дисками — это полное копирование, не держим им event loop бота
+                await asyncio.to_thread(claim_file, path, self.settings, self.jobs)
+
+class InotifyWatcher:
+    """
+    Запасной событийный watcher для Linux без watchfiles (inotify через ctypes):
+    - Ждём в epoll сразу на inotify fd и на eventfd остановки — без таймеров и опроса
+    - IN_CLOSE_WRITE/IN_MOVED_TO приходят, когда файл уже дописан, — стабилизацию ждать не нужно
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT_HDR = struct.Struct("iIII")  # wd, mask, cookie, len
+    STARTUP_SETTLE = 2.0  # сек; окно проверки стабильности для файлов, лежавших до старта
+
+    def __init__(self, settings: Settings, jobs: JobQueue):
+        self.settings = settings
+        self.jobs = jobs
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(settings.input_dir), self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        )
+        if wd < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch")
+        self._stop_fd = os.eventfd(0, os.EFD_CLOEXEC)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def available() -> bool:
+        return sys.platform.startswith("linux") and hasattr(os, "eventfd")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        os.eventfd_write(self._stop_fd, 1)
+        self._thread.join(timeout=2)
+
+    def _run(self):
+        log("Inotify watcher: запущен.")
+        # файлы, которые лежали в inbox до старта: их могут ещё дописывать, поэтому один раз
+        # ждём STARTUP_SETTLE и забираем только те, чей размер не изменился
+        startup: Dict[Path, int] = {}
+        for p in self.settings.input_dir.glob("*"):
+            if p.is_file() and p.name.lower().endswith(SUPPORTED_SUFFIX_TUPLE):
+                try:
+                    startup[p] = p.stat().st_size
+                except OSError:
+                    continue
+        deadline = time.monotonic() + self.STARTUP_SETTLE
+        sel = selectors.EpollSelector()
+        sel.register(self._fd, selectors.EVENT_READ)
+        sel.register(self._stop_fd, selectors.EVENT_READ)
+        try:
+            while True:
+                timeout = max(0.0, deadline - time.monotonic()) if startup else None
+                for key, _ in sel.select(timeout=timeout):
+                    if key.fd == self._stop_fd:
+                        return
+                    try:
+                        self._drain()
+                    except Exception as e:
+                        log(f"Watcher error: {e}")
+                if startup and time.monotonic() >= deadline:
+                    self._claim_settled(startup)
+                    startup = {}
+        finally:
+            sel.close()
+            os.close(self._fd)
+            os.close(self._stop_fd)
 
-# -------------------- polling watcher (без watchdog) --------------------
+    def _claim_settled(self, sizes: Dict[Path, int]):
+        for path, size in sizes.items():
+            try:
+                settled = path.stat().st_size == size and size > 0
+            except OSError:
+                continue  # уже забрали по событию или удалили
+            # размер менялся — файл ещё пишут, его заберёт IN_CLOSE_WRITE
+            if settled:
+                claim_file(path, self.settings, self.jobs)
+
+    def _drain(self):
+        # читаем до EAGAIN: за одно пробуждение забираем все накопившиеся события
+        while True:
+            try:
+                buf = os.read(self._fd, 8192)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, name_len = self._EVENT_HDR.unpack_from(buf, offset)
+                offset += self._EVENT_HDR.size
+                name = buf[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if not name or not mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    continue
+                fname = os.fsdecode(name)
+                path = self.settings.input_dir / fname
+                # exists(): файл мог уже забрать стартовый проход
+                if fname.lower().endswith(SUPPORTED_SUFFIX_TUPLE) and path.exists():
+                    claim_file(path, self.settings, self.jobs)
 
 class Poller:
     """
-    Простой опрос папки:
+    Запасной вариант (FORCE_POLL=1, например сетевая ФС, или нет ни watchfiles, ни inotify):
     - Каждые POLL_INTERVAL секунд сканим INPUT_DIR
     - Ждём стабилизации размера файла (STABLE_TICKS подряд)
     - Как только файл стабилен — ПЕРЕНОСИМ его в WORK_DIR (claim) и ставим в очередь
+    - Файл, размер которого меняется дольше SEEN_TTL, больше не отслеживаем, пока он лежит в inbox
+      (освобождаем место в трекере для остальных)
     """
-    POLL_INTERVAL = 0.5
+    POLL_INTERVAL = 2.0
     STABLE_TICKS = 3
+    MAX_TRACKED = 10_000  # предел трекера: мусор в inbox не должен раздувать память
+    SEEN_TTL = 3600       # сек; файл, который так и не стабилизировался, перестаём отслеживать
 
     def __init__(self, settings: Settings, jobs: JobQueue):
         self.settings = settings
         self.jobs = jobs
-        self._seen: Dict[Path, Dict[str, int]] = {}
+        # LRU: имя файла → (размер, стабильных тиков, когда впервые увидели); свежие — в конце
+        self._seen: "OrderedDict[str, Tuple[int, int, float]]" = OrderedDict()
+        # имена, не стабилизировавшиеся за SEEN_TTL: не трекаем заново, пока файл не исчезнет
+        self._expired: set = set()
         self._stop = threading.Event()
         self._thread = threading.Thread(target=self._run, daemon=True)
 
@@ -222,44 +833,65 @@ class Poller:
                 self._scan_once()
             except Exception as e:
                 log(f"Watcher error: {e}")
-            time.sleep(self.POLL_INTERVAL)
+            # wait() вместо sleep: stop() будит поток сразу, а не через POLL_INTERVAL
+            self._stop.wait(self.POLL_INTERVAL)
 
     def _scan_once(self):
-        for p in self.settings.input_dir.glob("*"):
-            if p.is_file() and p.suffix.lower() in SUPPORTED_EXTS:
-                self._tick(p)
+        # scandir: тип файла приходит из getdents, stat() кэшируется в DirEntry — один syscall на файл
+        present = set()
+        with os.scandir(self.settings.input_dir) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False) or not entry.name.lower().endswith(SUPPORTED_SUFFIX_TUPLE):
+                    continue
+                try:
+                    size = entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+                present.add(entry.name)
+                self._tick(entry.name, size)
 
-        # чистим трекер для исчезнувших файлов
-        for p in list(self._seen.keys()):
-            if not p.exists():
-                self._seen.pop(p, None)
+        # _tick двигает увиденные в конец, поэтому исчезнувшие копятся в голове —
+        # чистим только её, без прохода по всему трекеру
+        while self._seen and next(iter(self._seen)) not in present:
+            self._seen.popitem(last=False)
+        # исчезнувший файл с тем же именем в будущем — уже новый файл, его снова можно отслеживать
+        if self._expired:
+            self._expired &= present
 
-    def _tick(self, path: Path):
-        try:
-            size = path.stat().st_size
-        except FileNotFoundError:
+    def _tick(self, name: str, size: int):
+        if name in self._expired:
             return
-
-        rec = self._seen.get(path)
-        if rec is None:
-            self._seen[path] = {"size": size, "stable": 0}
+        prev = self._seen.get(name)
+        if prev is None:
+            # трекер полон — новое имя возьмём в следующих сканах, когда освободится место;
+            # вытеснять отслеживаемые файлы нельзя, иначе ни один не доживёт до STABLE_TICKS
+            if len(self._seen) < self.MAX_TRACKED:
+                self._seen[name] = (size, 0, time.monotonic())
             return
 
-        if size == rec["size"] and size > 0:
-            rec["stable"] += 1
+        prev_size, stable, first_seen = prev
+        stable = stable + 1 if size == prev_size and size > 0 else 0
+
+        if stable >= self.STABLE_TICKS:
+            self._seen.pop(name, None)
+            claim_file(self.settings.input_dir / name, self.settings, self.jobs)
+        elif time.monotonic() - first_seen > self.SEEN_TTL:
+            self._seen.pop(name, None)
+            self._expired.add(name)
+            log(f"Poller: {name} не стабилизировался за {self.SEEN_TTL} сек — больше не отслеживаю.")
         else:
-            rec["size"] = size
-            rec["stable"] = 0
+            self._seen[name] = (size, stable, first_seen)
+            self._seen.move_to_end(name)
 
-        if rec["stable"] >= self.STABLE_TICKS:
-            # Claim: переносим в WORK и ставим в очередь
-            self._seen.pop(path, None)
-            try:
-                claimed = safe_move(path, self.settings.work_dir, keep_ext=True)
-                self.jobs.add(Job(src_path=claimed, is_temp=False))
-                log(f"Claimed: {claimed.name}")
-            except Exception as e:
-                log(f"Не удалось перенести в work/: {e}")
+def watch_mode() -> str:
+    """watchfiles → inotify (Linux) → poll; FORCE_POLL=1 сразу выбирает опрос."""
+    if os.getenv("FORCE_POLL") == "1":
+        return "poll"
+    if awatch is not None:
+        return "watchfiles"
+    if InotifyWatcher.available():
+        return "inotify"
+    return "poll"
 
 # -------------------- Telegram bot --------------------
 
@@ -269,6 +901,8 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("pong")
 
+RESULT_TIMEOUT = 120  # сколько ждём видео для ответа в чат, сек
+
 def _best_photo_file(photos):
     return photos[-1] if photos else None
 
@@ -291,44 +925,63 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             return
 
-        # Скачиваем во временный файл вне inbox
-        tmp_name = f"tg_{unique_stem('image')}{suffix}"
-        tmp_path = settings.tmp_dir / tmp_name
-        await file_obj.download_to_drive(str(tmp_path))
-
-        # Сразу переносим в WORK и ставим в очередь (единый конвейер)
-        claimed = safe_move(tmp_path, settings.work_dir, keep_ext=True)
-        jobs.add(Job(src_path=claimed, is_temp=True))
-        await message.reply_text("Принял, конвертирую…")
-
-        # Когда воркер закончит — пришлём видео
-        # Простой поллинг готового файла (имя видео заранее не знаем). Отправим самое свежее из ready_dir.
-        # Это простая стратегия, в продакшене можно делать корелляцию по id.
-        def find_latest_mp4(dirpath: Path) -> Optional[Path]:
-            mp4s = list(dirpath.glob("*.mp4"))
-            if not mp4s:
-                return None
-            return max(mp4s, key=lambda p: p.stat().st_mtime)
-
-        # подождём до 60 сек результат (обычно быстрее)
-        for _ in range(120):
-            latest = find_latest_mp4(settings.ready_dir)
-            if latest and datetime.now().timestamp() - latest.stat().st_mtime <= 70:
-                # отправим файл
-                await message.reply_video(video=open(latest, "rb"), supports_streaming=True, caption="Готово ✅")
-                break
-            await asyncio.sleep(0.5)
+        # Качаем сразу в WORK: .part → rename в той же папке (атомарно, без копирования)
+        claimed = settings.work_dir / f"tg_{unique_stem('image')}{suffix.lower()}"
+        part_path = claimed.with_suffix(claimed.suffix + ".part")
+        await file_obj.download_to_drive(str(part_path))
+        os.replace(str(part_path), str(claimed))
+
+        # То же фото уже конвертировали — отдаём готовое видео без ffmpeg
+        key = await asyncio.to_thread(file_key, claimed)
+        video_path = jobs.cached_video(key)
+        if video_path is not None:
+            log(f"Дубликат: {claimed.name} → {video_path.name}")
+            await asyncio.to_thread(safe_move, claimed, settings.archive_dir, True)
+        else:
+            # Ставим в очередь (единый конвейер); воркер вернёт путь к видео через future
+            fut: concurrent.futures.Future = concurrent.futures.Future()
+            job = Job(src_path=claimed, is_temp=True, content_key=key, result_future=fut)
+            jobs.add(job)
+            await message.reply_text("Принял, конвертирую…")
+
+            try:
+                video_path = await asyncio.wait_for(asyncio.wrap_future(fut), timeout=RESULT_TIMEOUT)
+            except asyncio.TimeoutError:
+                done = min(100, int(job.progress_s * 100 / max(1, settings.duration)))
+                await message.reply_text(
+                    f"Видео не успело за отведённое время (готово ~{done}%) — оно появится в readyforinstagram/."
+                )
+                return
+        # читаем mp4 в потоке, чтобы не блокировать event loop; таймауты с запасом — без повторной заливки
+        data = await asyncio.to_thread(video_path.read_bytes)
+        await message.reply_video(
+            video=data,
+            filename=video_path.name,
+            supports_streaming=True,
+            caption="Готово ✅",
+            read_timeout=60,
+            write_timeout=120,
+        )
 
     except subprocess.CalledProcessError as e:
-        await update.message.reply_text(f"FFmpeg ошибка: {e}")
+        log(f"FFmpeg ошибка: {describe_ffmpeg_error(e)}")
+        await update.message.reply_text(ffmpeg_error_for_chat(e, settings))
     except Exception as e:
         await update.message.reply_text(f"Ошибка: {e}")
 
 # -------------------- main --------------------
 
-import asyncio
+def install_uvloop():
+    # uvloop (libuv) быстрее стандартного цикла на I/O; на Windows его нет — остаёмся на asyncio
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    log("asyncio: uvloop включён.")
 
 def main():
+    install_uvloop()
     check_ffmpeg()
     settings = load_settings()
 
@@ -337,18 +990,58 @@ def main():
     log(f"READY_DIR={settings.ready_dir}")
     log(f"ARCHIVE_DIR={settings.archive_dir}")
     log(f"FAILED_DIR={settings.failed_dir}")
+    log(f"ENCODER={settings.video_encoder}")
+    log(f"FFMPEG_PARALLEL={settings.ffmpeg_parallel} (threads={settings.ffmpeg_threads})")
 
-    # очередь + один воркер
+    # очередь + пул воркеров
     jobs = JobQueue(settings)
     jobs.start()
 
-    # поллер inbox
-    poller = Poller(settings, jobs)
-    poller.start()
+    # watcher inbox: события ФС (watchfiles/inotify) или запасной поллер
+    poller: Optional[Union[Poller, InotifyWatcher]] = None
+    watcher: Optional[FsWatcher] = None
+    mode = watch_mode()
+    if mode == "watchfiles":
+        watcher = FsWatcher(settings, jobs)
+    else:
+        if mode == "inotify":
+            try:
+                poller = InotifyWatcher(settings, jobs)
+            except OSError as e:
+                log(f"inotify недоступен ({e}) — переходим на опрос.")
+        if poller is None:
+            poller = Poller(settings, jobs)
+        poller.start()
 
     # телеграм-бот (опционально)
     if settings.bot_token:
-        app = Application.builder().token(settings.bot_token).build()
+        watcher_task: Optional[asyncio.Task] = None
+
+        async def post_init(application: Application):
+            # post_init вызывается до Application.start(), поэтому задачу держим сами, а не через create_task PTB
+            nonlocal watcher_task
+            if watcher:
+                watcher_task = asyncio.create_task(watcher.run())
+
+        async def post_stop(application: Application):
+            # цикл ещё работает: даём watcher'у выйти из awatch, иначе отменяем
+            if watcher_task is None:
+                return
+            watcher.stop()
+            try:
+                await asyncio.wait_for(watcher_task, timeout=5)
+            except asyncio.TimeoutError:
+                pass  # wait_for уже отменил задачу
+            except Exception as e:
+                log(f"Watcher error: {e}")
+
+        app = (
+            Application.builder()
+            .token(settings.bot_token)
+            .post_init(post_init)
+            .post_stop(post_stop)
+            .build()
+        )
         app.bot_data["settings"] = settings
         app.bot_data["jobs"] = jobs
         app.add_handler(CommandHandler("start", cmd_start))
@@ -359,17 +1052,22 @@ def main():
         try:
             app.run_polling(close_loop=False, allowed_updates=Update.ALL_TYPES)
         finally:
-            poller.stop()
+            if poller:
+                poller.stop()
             jobs.stop()
     else:
         log("BOT_TOKEN не задан — бот не поднимаем. Watcher работает. Нажми Ctrl+C для выхода.")
         try:
-            while True:
-                time.sleep(1)
+            if watcher:
+                asyncio.run(watcher.run())
+            else:
+                while True:
+                    time.sleep(1)
         except KeyboardInterrupt:
             pass
         finally:
-            poller.stop()
+            if poller:
+                poller.stop()
             jobs.stop()
 
 if __name__ == "__main__":
@@ -6,15 +6,18 @@ import os
 
 console = Console()
 
+# баннер и таблица меню не меняются — собираем один раз при импорте
+_BANNER = pyfiglet.figlet_format("Insta Tool", font="slant")
+
 def clear():
     os.system("cls" if os.name == "nt" else "clear")
 
 def banner():
-    console.print(pyfiglet.figlet_format("Insta Tool", font="slant"), style="bold cyan")
+    console.print(_BANNER, style="bold cyan")
     console.print("📸 [bold green]Instagram Content Helper[/bold green]", justify="center")
     console.print("—"*50, style="dim")
 
-def menu():
+def _build_menu_table():
     table = Table(show_header=True, header_style="bold magenta")
     table.add_column("№", style="dim", width=5)
     table.add_column("Действие")
@@ -22,7 +25,12 @@ def menu():
     table.add_row("2", "Обработать фото в видео")
     table.add_row("3", "Выложить пост в Instagram")
     table.add_row("4", "Выйти")
-    console.print(table)
+    return table
+
+_MENU_TABLE = _build_menu_table()
+
+def menu():
+    console.print(_MENU_TABLE)
 
 def main():
     while True: